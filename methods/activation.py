@@ -5,7 +5,8 @@
 
 import logging
 import math
-from typing import Any, List, Optional, Tuple, Union
+import weakref
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -16,6 +17,9 @@ from .core import _CAM
 
 __all__ = ["CAM", "ScoreCAM", "SSCAM", "ISCAM"]
 
+# Compiled models are shared across extractor instances built on the same model
+_COMPILED_MODELS: "weakref.WeakKeyDictionary[nn.Module, nn.Module]" = weakref.WeakKeyDictionary()
+
 
 class CAM(_CAM):
     r"""Implements a class activation map extractor as described in `"Learning Deep Features for Discriminative
@@ -80,8 +84,12 @@ class CAM(_CAM):
         # squeeze to accomodate replacement by Conv1x1
         if self._fc_weights.ndim > 2:
             self._fc_weights = self._fc_weights.view(*self._fc_weights.shape[:2])
+        # Last selected FC weights with their class index and the version of the FC parameter they were taken from
+        # (the `.data` alias above has its own version counter, which in-place updates of the parameter never bump)
+        self._fc_param = self.submodule_dict[fc_name].weight
+        self._weights_cache: Tuple[Any, Any, Optional[Tensor]] = (None, None, None)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _get_weights(
         self,
         class_idx: Union[int, List[int]],
@@ -89,11 +97,16 @@ class CAM(_CAM):
     ) -> List[Tensor]:
         """Computes the weight coefficients of the hooked activation maps."""
 
-        # Take the FC weights of the target class
-        if isinstance(class_idx, int):
-            return [self._fc_weights[class_idx, :].unsqueeze(0)]
-        else:
-            return [self._fc_weights[class_idx, :]]
+        key = class_idx if isinstance(class_idx, int) else tuple(class_idx)
+        version = (self._fc_param.data_ptr(), self._fc_param._version)
+        if self._weights_cache[0] != key or self._weights_cache[1] != version:
+            # Take the FC weights of the target class
+            if isinstance(class_idx, int):
+                weights = self._fc_weights[class_idx, :].unsqueeze(0)
+            else:
+                weights = self._fc_weights[class_idx, :]
+            self._weights_cache = (key, version, weights)
+        return [self._weights_cache[2]]  # type: ignore[list-item]
 
 
 class ScoreCAM(_CAM):
@@ -151,111 +164,158 @@ class ScoreCAM(_CAM):
         self.bs = batch_size
         # Ensure ReLU is applied to CAM before normalization
         self._relu = True
+        # Map the spatial shape of a hooked activation to its position among the inputs (earlier tables take priority)
+        shape_list = [[4,3,2],[3,3,1],[11,6,1],[6,3,1]]
+        shape_list_single = [[4,3,2],[11,6,4],[11,6,1],[6,3,1]]
+        shape_list_multiscale = [[41,41,30],[41,41,6],[21,21,3],[6,6,1],[11,11,2]]
+        self._shape_lut = {tuple(s): 1 for s in shape_list_multiscale}
+        self._shape_lut.update({tuple(s): i for i, s in enumerate(shape_list_single)})
+        self._shape_lut.update({tuple(s): i for i, s in enumerate(shape_list)})
+        # Baseline model output, keyed by the stored input it was computed from
+        self._logits_cache: Tuple[Any, Any] = (None, None)
+        # Stored inputs copied to other devices, valid for the stored input they were copied from
+        self._device_input_cache: Tuple[Any, Dict[Tuple[int, torch.device], Tensor]] = (None, {})
+        # Reusable pinned host buffers (with the event of their last transfer) to stage host-to-device copies
+        self._pinned_buffers: Dict[Tuple[torch.Size, torch.dtype], Tuple[Tensor, Any]] = {}
+        # Sample index of each flattened (sample, channel) pair, keyed by (N, C, device)
+        self._idcs_cache: Dict[Tuple[int, int, torch.device], Tensor] = {}
+        # Volumetric convolutions pick faster kernels with channels-last weights (other layers are left as is)
+        for mod in model.modules():
+            if isinstance(mod, nn.Conv3d):
+                mod.to(memory_format=torch.channels_last_3d)
 
     def _store_input(self, module: nn.Module, input: Tensor) -> None:
         """Store model input tensor."""
 
         if self._hooks_enabled:
-            if len(input[0])>1:
-                self._input = input[0].copy()
+            # Keep references on the input device, detached from the graph (no copy)
+            self._input = self._detach(input[0])
+
+    @staticmethod
+    def _detach(t: Any) -> Any:
+        """Detach tensors from the graph, recursing into lists and passing other objects through."""
+
+        if torch.is_tensor(t):
+            return t.detach()
+        elif isinstance(t, list):
+            return [ScoreCAM._detach(x) for x in t]
+        else:
+            return t
+
+    @torch.inference_mode()
+    def _get_logits(self) -> Any:
+        """Forward the stored input, reusing the previous output if the input has not changed."""
+
+        if self._logits_cache[0] is not self._input:
+            self._logits_cache = (self._input, self.model(self._input))
+        return self._logits_cache[1]
+
+    def _to_device(self, tensor: Tensor, device: torch.device) -> Tensor:
+        """Move a tensor to a device, staging host tensors in a reusable pinned buffer for a non-blocking copy."""
+
+        if tensor.device == device:
+            return tensor
+        if tensor.device.type != "cpu" or device.type != "cuda":
+            return tensor.to(device)
+
+        key = (tensor.shape, tensor.dtype)
+        if key in self._pinned_buffers:
+            staged, event = self._pinned_buffers[key]
+            # The previous transfer out of this buffer must be done before it gets overwritten
+            event.synchronize()
+        else:
+            staged = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        staged.copy_(tensor)
+        out = staged.to(device, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(device))
+        self._pinned_buffers[key] = (staged, event)
+        return out
+
+    def _get_device_input(self, tensor: Tensor, device: torch.device) -> Tensor:
+        """Copy a stored input tensor to a device, once per stored input."""
+
+        if self._device_input_cache[0] is not self._input:
+            self._device_input_cache = (self._input, {})
+        key = (id(tensor), device)
+        if key not in self._device_input_cache[1]:
+            self._device_input_cache[1][key] = self._to_device(tensor, device)
+        return self._device_input_cache[1][key]
+
+    def _get_idcs(self, b: int, c: int, device: torch.device) -> Tensor:
+        """Sample index of each element of a flattened (N * C) batch."""
+
+        key = (b, c, device)
+        if key not in self._idcs_cache:
+            self._idcs_cache[key] = torch.arange(b, device=device).repeat_interleave(c)
+        return self._idcs_cache[key]
+
+    def _get_compiled_model(self) -> nn.Module:
+        """Compile the model for the repeated masked forwards, falling back to eager mode on older PyTorch."""
+
+        compiled = _COMPILED_MODELS.get(self.model)
+        if compiled is None:
+            if hasattr(torch, "compile"):
+                # Each input scale has its own shape, leave room for the extra recompilations
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 128)
+                compiled = torch.compile(self.model, mode="reduce-overhead", fullgraph=False)
             else:
-               self._input = input[0].data.clone()
+                compiled = self.model
+            _COMPILED_MODELS[self.model] = compiled
+        return compiled
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _get_score_weights(self, activations: List[Tensor], class_idx: Union[int, List[int]]) -> List[Tensor]:
 
-        b, c = activations[0].shape[1:3]#b,c means
-        score_input_list=list()
-        weights_list = list()
-        for i in range(len(activations)):
-            b, c = activations[i].shape[:2]
-            weights = torch.zeros((b,c), dtype=activations[i].dtype).to(device=activations[i].device)
-            weights_list.append(weights)
-        idcs_list = list()
-        for i in range(len(activations)):
-            b, c = activations[i].shape[:2]
-            idcs = torch.arange(b).repeat_interleave(c)
-            idcs_list.append(idcs)
-        # (N * C, I, H, W)
-        # for act in activations[0]:
-        #     scored_inputs = [
-        #         (act.unsqueeze(2) * torch.unsqueeze(torch.squeeze(self._input[0][3][0]).cuda(),dim=2)).view(b * c, *self._input[0][3].shape[1:])
-        #       ].view(b * c, *self._input[0][3].shape[1:]
-        # scored_inputs = [(act.unsqueeze(2) * torch.unsqueeze(torch.squeeze(self._input[0][3][0]).cuda(),dim=2))
-        #                     for act in activations[0]]
-        # compute on singe channel leading to OOM
-        for i in range(len(activations)):
-            b,c = activations[i].shape[:2]
-            # b = 1
-            h,w,d= self._input[0][i].shape[2:]
-            score_input =torch.zeros([b,c,h,w,d])
-            #.view(b * c, h,w,d) activations[i][0,...].cpu()*self._input[0][i][0,...].cpu()+
-            # activations[i][1, ...].cpu() * self._input[0][i][1, ...].cpu()+
-            score_input_0 = (activations[i][0,...].cpu() * 10 +  self._input[0][i][0,...].cpu()).unsqueeze(0)
-            score_input_1 = (activations[i][1, ...].cpu() * 10+  self._input[0][i][1, ...].cpu() ).unsqueeze(0)
-            score_input = torch.cat([score_input_0,score_input_1],dim=0)
-            # for batch in range(1,activations[i].shape[0]):
-            #     for channel in range(1,activations[i].shape[1]):
-            #         score_input_tmp = (activations[i][batch,channel,:,:,:]*self._input[0][i][batch,0,...].cuda()).unsqueeze(0)
-            #         score_input =torch.cat([score_input,score_input_tmp],dim=0)
-            # score_input =  [activations[i][:,c,:,:,:].cpu().numpy() * self._input[0][i].cpu().numpy() for c in range(activations[i].shape[1]-1)]
-            # score_input_0 = torch.mul(activations[i][0],self._input[0][i][0].cuda()).view(1 * c, h,w,d)
-            # del activations[i][0], score_input_0
-            # score_input_1 = torch.mul(activations[i][1], self._input[0][i][1].cuda()).view(1 * c, h, w, d)
-            # score_input = torch.cat([score_input_0.unsqueeze(0),score_input_0.unsqueeze(0)],dim=0)
-            score_input_list.append(score_input)
-            # del
-        # scored_inputs = torch.mul(activations.unsqueeze(1),self._input[0][3])
+        b, c = activations[0].shape[:2]
         # Initialize weights
         # (N * C)
-
-
-           # weights = [torch.zeros(b * c, dtype=t.dtype).to(device=t.device) for t in activations]
+        weights = torch.zeros(b * c, dtype=activations[0].dtype, device=activations[0].device)
+        # Scales with fewer channels are spread over the channels of the first scale
+        ratios = [max(c // act.shape[1], 1) for act in activations]
+        # The stored inputs can live on another device than the activations (e.g. CPU inputs fed to DataParallel)
+        inputs = [self._get_device_input(inp, act.device) for act, inp in zip(activations, self._input[0])]
 
         # (N, M)
-        # .repeat_interleave((score_input_list[0][0].shape[0]/score_input_list[0][1].shape[0])-1,dim=1)
-        if score_input_list[1].shape[1] != 512:
-            score_input_list[1] = score_input_list[1].repeat_interleave(int(score_input_list[0].shape[1]/score_input_list[1].shape[1]),dim=1)
-        logits = self.model(self._input)
-        # # idcs = torch.arange(b).repeat_interleave(c)
-        for channel in range(score_input_list[0][0].shape[0]):
-
-        # for idx, scored_input in enumerate(scored_inputs):
-        #     for _idx in range(math.ceil(weights[channel].numel() / self.bs)):
-                # _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, weights[channel].numel()))
-                slice_input = [score_input_list[0][:,channel,:,:,:].unsqueeze(1).cuda(),
-                               score_input_list[1][:,channel,:,:,:].unsqueeze(1).cuda(),
-                               score_input_list[2][:,channel,:,:,:].unsqueeze(1).cuda(),
-                               score_input_list[3][:,channel,:,:,:].unsqueeze(1).cuda()]
-                slice_input = [slice_input, self._input[1]]
-                # cic = self.model(slice_input)
-                cic = self.model(slice_input)[1]-logits[1]
-                if isinstance(class_idx, int):
-                    try:
-                        weights[:,channel] = cic[:, class_idx]
-                    except RuntimeError:
-                        weights[:,channel] = cic[:, class_idx]
-                else:
-                    _target = torch.tensor(class_idx, device=cic.device)[idcs[_slice]]
-                    weights[idx][_slice] = cic.gather(1, _target.view(-1, 1)).squeeze(1)
-        #     # Process by chunk (GPU RAM limitation)
-        #     for _idx in range(math.ceil(weights[idx].numel() / self.bs)):
-        #
-        #         _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, weights[idx].numel()))
-        #         # Get the softmax probabilities of the target class
-        #         # (*, M)
-        #         cic = self.model(scored_input[_slice]) - logits[idcs[_slice]]
-        #         if isinstance(class_idx, int):
-        #             weights[idx][_slice] = cic[:, class_idx]
-        #         else:
-        #             _target = torch.tensor(class_idx, device=cic.device)[idcs[_slice]]
-        #             weights[idx][_slice] = cic.gather(1, _target.view(-1, 1)).squeeze(1)
+        base_logits = self._get_logits()[1]
+        idcs = self._get_idcs(b, c, weights.device)
+        # Target class of each sample, moved to the device once
+        class_idcs = None if isinstance(class_idx, int) else torch.as_tensor(class_idx, device=weights.device)
+        chans = torch.arange(c, device=weights.device).repeat(b)
+        model = self._get_compiled_model()
+
+        # Process by chunk (GPU RAM limitation)
+        for _idx in range(math.ceil(weights.numel() / self.bs)):
+
+            _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, weights.numel()))
+            _idcs = idcs[_slice]
+            _chans = chans[_slice]
+            # Only build the masked inputs of the current chunk (the full (N * C, 1, H, W, D) tensor leads to OOM)
+            # Each scale is indexed with indices on its own device (no-op copies when they already match)
+            # (*, 1, H, W, D)
+            scored_input = [
+                (
+                    act[_idcs.to(act.device), _chans.to(act.device) // ratio].unsqueeze(1) * 10
+                    + inp[_idcs.to(inp.device)]
+                ).contiguous(memory_format=torch.channels_last_3d)
+                for act, ratio, inp in zip(activations, ratios, inputs)
+            ]
+            # Get the softmax probabilities of the target class (half precision forward, scores upcast to float32)
+            with torch.autocast("cuda", dtype=torch.float16, enabled=weights.is_cuda):
+                cic = model([scored_input, self._input[1]])[1]
+            cic = cic.float() - base_logits[_idcs]
+            if isinstance(class_idx, int):
+                weights[_slice] = cic[:, class_idx]
+            else:
+                _target = class_idcs[_idcs]  # type: ignore[index]
+                weights[_slice] = cic.gather(1, _target.view(-1, 1)).squeeze(1)
 
         # Reshape the weights (N, C)
-        weights = torch.where(torch.isnan(weights), torch.full_like(weights, 0), weights)
+        # Scrub NaNs in-place (infinite values are left untouched)
+        weights = weights.nan_to_num_(nan=0.0, posinf=math.inf, neginf=-math.inf).view(b, c)
         return torch.softmax(weights, 1)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _get_weights(
         self,
         class_idx: Union[int, List[int]],
@@ -267,51 +327,20 @@ class ScoreCAM(_CAM):
         # self.hook_g: List[Tensor]
         # Normalize the activation
         # (N, C, H', W')
-        upsampled_a_list = list()
         activation_list = list()
-        shape_ =list()
-        shape_list = [[4,3,2],[3,3,1],[11,6,1],[6,3,1]]
-        shape_list_single = [[4,3,2],[11,6,4],[11,6,1],[6,3,1]]
-        shape_list_multiscale = [[41,41,30],[41,41,6],[21,21,3],[6,6,1],[11,11,2]]
-        # shape_alff =
-        # shape_dfc =
-        # shape_fc =
-        # shape_fc =
-        single_ = False
-        dfc_ = False
-        multi_scale = False
-        for act in set(self.hook_a_list):
+        shape_ = set()
+        # Deduplicate by identity: hashing tensors is slow and set ordering is not deterministic
+        for act in {id(act): act for act in self.hook_a_list}.values():
             if act.shape in shape_:
                 continue
             activation_a = [self._normalize(act, act.ndim - 2)]
-            shape_tmp = activation_a[0][0,0,...].cpu().shape
-            # index_ = shape_list.index([shape_tmp[0],shape_tmp[1],shape_tmp[2]])
-            try :
-                index_ = shape_list.index([shape_tmp[0],shape_tmp[1],shape_tmp[2]])
-                single_ = True
-            except ValueError:
-                try :
-                    index_ = shape_list_single.index([shape_tmp[0],shape_tmp[1],shape_tmp[2]])
-                    dfc_ = True
-                except ValueError:
-                    try :
-                       index_ = shape_list_multiscale.index([shape_tmp[0], shape_tmp[1], shape_tmp[2]])
-                       index_ = 1
-                    except ValueError:
-                        print('no value')
-                    # if len(index_) > 0:
-                    #     index_ = 1
-                    multi_scale = True
+            shape_tmp = activation_a[0].shape[2:]
+            index_ = self._shape_lut.get(tuple(shape_tmp))
+            if index_ is None:
+                logging.warning(f"unexpected activation shape {tuple(shape_tmp)}, skipping it.")
+                continue
             activation_list.insert(index_, activation_a[0])
-            # upsampled_a_list.append(activation_a)
-            shape_.append(act.shape)
-        # exchange activation map
-        # upsampled_a_tmp = upsampled_a_list[3]
-        # upsampled_a_list[3] = upsampled_a_list[1]
-        # upsampled_a_list[1] = upsampled_a_tmp
-        # upsampled_a_tmp = upsampled_a_list[3]
-        # upsampled_a_list[3] = upsampled_a_list[2]
-        # upsampled_a_list[3] = upsampled_a_tmp
+            shape_.add(act.shape)
         activations = activation_list.copy()
         # upsampled_a = [self._normalize(act, act.ndim - 2) for act in self.hook_a]
         # upsampled_a = upsampled_a[0][0,:,:,:,:]
@@ -320,25 +349,10 @@ class ScoreCAM(_CAM):
         # (N, C, H, W)
         spatial_dims = self._input[0][3].ndim - 2
         interpolation_mode = "bilinear" if spatial_dims == 2 else "trilinear" if spatial_dims == 3 else "nearest"
-        # doesn't need to three situation
-        if single_ == True and dfc_ ==False:
-            for i in range(len(upsampled_a_list)):
-                upsampled_a_list[i]= F.interpolate(upsampled_a_list[i], self._input[0][i].shape[2:], mode="trilinear",
-                                             align_corners=False)
-        elif single_ == True and dfc_ == True and multi_scale == False:
-            for i in range(len(upsampled_a_list)):
-                upsampled_a_list[i]= F.interpolate(upsampled_a_list[i], self._input[0][i].shape[2:], mode="trilinear",
-                                             align_corners=False)
-        else:
-            for i in range(len(upsampled_a_list)):
-                upsampled_a_list[i] = F.interpolate(upsampled_a_list[i], self._input[0][i].shape[2:], mode="trilinear",
-                                                    align_corners=False)
-        # upsampled_a= F.interpolate(torch.squeeze(upsampled_a[0]), self._input[0][3].shape[2:4], mode="bilinear",
-        #                                  align_corners=False)
-
-        # for up_a in upsampled_a:
-        #     upsampled_a_test = F.interpolate(torch.squeeze(upsampled_a), self._input[0][3].shape[2:4], mode="bilinear", align_corners=False)
-
+        upsampled_a_list = [
+            F.interpolate(act, self._input[0][i].shape[2:], mode=interpolation_mode, align_corners=False)
+            for i, act in enumerate(activations)
+        ]
 
         # Disable hook updates
         self._hooks_enabled = False
@@ -418,41 +432,56 @@ class SSCAM(ScoreCAM):
 
         self.num_samples = num_samples
         self.std = std
-        self._distrib = torch.distributions.normal.Normal(0, self.std)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _get_score_weights(self, activations: List[Tensor], class_idx: Union[int, List[int]]) -> List[Tensor]:
 
         b, c = activations[0].shape[:2]
 
-        # Initialize weights
-        # (N * C)
-        weights = [torch.zeros(b * c, dtype=t.dtype).to(device=t.device) for t in activations]
+        # (N * C) for each activation
+        weights: List[Tensor] = []
 
         # (N, M)
-        logits = self.model(self._input)
-        idcs = torch.arange(b).repeat_interleave(c)
-
-        for idx, act in enumerate(activations):
-            # Add noise
-            for _ in range(self.num_samples):
-                noise = self._distrib.sample(act.size()).to(device=act.device)
-                # (N, C, I, H, W)
-                scored_input = (act + noise).unsqueeze(2) * self._input.unsqueeze(1)
-                # (N * C, I, H, W)
-                scored_input = scored_input.view(b * c, *scored_input.shape[2:])
-
-                # Process by chunk (GPU RAM limitation)
-                for _idx in range(math.ceil(weights[idx].numel() / self.bs)):
-
-                    _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, weights[idx].numel()))
-                    # Get the softmax probabilities of the target class
-                    cic = self.model(scored_input[_slice]) - logits[idcs[_slice]]
-                    if isinstance(class_idx, int):
-                        weights[idx][_slice] += cic[:, class_idx]
-                    else:
-                        _target = torch.tensor(class_idx, device=cic.device)[idcs[_slice]]
-                        weights[idx][_slice] += cic.gather(1, _target.view(-1, 1)).squeeze(1)
+        logits = self._get_logits()
+        idcs = self._get_idcs(b, c, activations[0].device)
+        # Target class of each sample, moved to the device once
+        class_idcs = None if isinstance(class_idx, int) else torch.as_tensor(class_idx, device=activations[0].device)
+
+        # Number of (noise sample, sample, channel) triplets, flattened with the noise sample outermost
+        total = self.num_samples * b * c
+
+        # (N, I, H, W)
+        inp = self._get_device_input(self._input, activations[0].device)
+
+        for act in activations:
+            # (N * C, H, W)
+            flat_act = act.flatten(0, 1)
+            scores: List[Tensor] = []
+
+            # Process by chunk (GPU RAM limitation)
+            for _idx in range(math.ceil(total / self.bs)):
+
+                _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, total))
+                # Position of each element of the chunk in the flattened (N * C) batch
+                _pos = torch.arange(_slice.start, _slice.stop, device=act.device) % (b * c)
+                _idcs = idcs[_pos]
+                # Only draw the noise and build the masked inputs of the current chunk
+                # (*, H, W)
+                noise = torch.randn(_pos.numel(), *act.shape[2:], dtype=act.dtype, device=act.device).mul_(self.std)
+                noisy_act = flat_act[_pos] + noise
+                # (*, I, H, W)
+                scored_input = torch.einsum("k...,ki...->ki...", noisy_act, inp[_idcs])
+                # Get the softmax probabilities of the target class
+                cic = self.model(scored_input) - logits[_idcs]
+                if isinstance(class_idx, int):
+                    scores.append(cic[:, class_idx])
+                else:
+                    _target = class_idcs[_idcs]  # type: ignore[index]
+                    scores.append(cic.gather(1, _target.view(-1, 1)).squeeze(1))
+
+            # Sum over the noise samples
+            # (S * N * C) -> (N * C)
+            weights.append(torch.cat(scores).view(self.num_samples, -1).sum(0))
 
         # Reshape the weights (N, C)
         return [torch.softmax(weight.div_(self.num_samples).view(b, c), -1) for weight in weights]
@@ -517,39 +546,58 @@ class ISCAM(ScoreCAM):
 
         self.num_samples = num_samples
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _get_score_weights(self, activations: List[Tensor], class_idx: Union[int, List[int]]) -> List[Tensor]:
 
         b, c = activations[0].shape[:2]
         # (N * C, I, H, W)
         scored_inputs = [
-            (act.unsqueeze(2) * self._input.unsqueeze(1)).view(b * c, *self._input.shape[1:]) for act in activations
+            torch.einsum("nc...,ni...->nci...", act, self._input).reshape(b * c, *self._input.shape[1:])
+            for act in activations
         ]
 
-        # Initialize weights
-        weights = [torch.zeros(b * c, dtype=t.dtype).to(device=t.device) for t in activations]
+        # (N * C) for each activation
+        weights: List[Tensor] = []
 
         # (N, M)
-        logits = self.model(self._input)
-        idcs = torch.arange(b).repeat_interleave(c)
-
-        for idx, scored_input in enumerate(scored_inputs):
-            _coeff = 0.0
+        logits = self._get_logits()
+        idcs = self._get_idcs(b, c, activations[0].device)
+        # Target class of each sample, moved to the device once
+        class_idcs = None if isinstance(class_idx, int) else torch.as_tensor(class_idx, device=activations[0].device)
+
+        # Cumulative integration coefficients
+        # (S)
+        coeffs = torch.arange(
+            1, self.num_samples + 1, dtype=scored_inputs[0].dtype, device=scored_inputs[0].device
+        ).div_(self.num_samples).cumsum(0)
+        # Number of (sample, channel, coefficient) triplets, flattened with the coefficient innermost so that a chunk
+        # reads each of its masked inputs once and scales it by consecutive coefficients
+        total = self.num_samples * b * c
+
+        for scored_input in scored_inputs:
+            scores: List[Tensor] = []
             # Process by chunk (GPU RAM limitation)
-            for sidx in range(self.num_samples):
-                _coeff += (sidx + 1) / self.num_samples
-
-                # Process by chunk (GPU RAM limitation)
-                for _idx in range(math.ceil(weights[idx].numel() / self.bs)):
-
-                    _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, weights[idx].numel()))
-                    # Get the softmax probabilities of the target class
-                    cic = self.model(_coeff * scored_input[_slice]) - logits[idcs[_slice]]
-                    if isinstance(class_idx, int):
-                        weights[idx][_slice] += cic[:, class_idx]
-                    else:
-                        _target = torch.tensor(class_idx, device=cic.device)[idcs[_slice]]
-                        weights[idx][_slice] += cic.gather(1, _target.view(-1, 1)).squeeze(1)
+            for _idx in range(math.ceil(total / self.bs)):
+
+                _slice = slice(_idx * self.bs, min((_idx + 1) * self.bs, total))
+                _flat = torch.arange(_slice.start, _slice.stop, device=scored_input.device)
+                # Position of each element of the chunk in the flattened (N * C) batch
+                _pos = _flat // self.num_samples
+                _idcs = idcs[_pos]
+                # (*, I, H, W)
+                _coeffs = coeffs[_flat % self.num_samples].view(-1, *(1,) * (scored_input.ndim - 1))
+                scaled_input = _coeffs * scored_input[_pos]
+                # Get the softmax probabilities of the target class
+                cic = self.model(scaled_input) - logits[_idcs]
+                if isinstance(class_idx, int):
+                    scores.append(cic[:, class_idx])
+                else:
+                    _target = class_idcs[_idcs]  # type: ignore[index]
+                    scores.append(cic.gather(1, _target.view(-1, 1)).squeeze(1))
+
+            # Sum over the coefficients
+            # (N * C * S) -> (N * C)
+            weights.append(torch.cat(scores).view(-1, self.num_samples).sum(1))
 
         # Reshape the weights (N, C)
         return [torch.softmax(weight.div_(self.num_samples).view(b, c), -1) for weight in weights]
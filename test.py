@@ -34,6 +34,7 @@ def test_epoch(epoch, data_loader, model, criterion, opt, logger):
     fa_arr = torch.zeros((opt.sample_size1_dti, opt.sample_size2_dti))
     dfc_arr = torch.zeros((opt.sample_size1_fc, opt.sample_size1_fc,opt.sample_duration_dfc))
     alff_arr = torch.zeros((opt.sample_size1_fmri, opt.sample_size2_fmri,opt.sample_duration_fmri))
+    cam = None
     for i ,(inputs,labels) in enumerate(data_loader):
         data_time.update(time.time() - end_time)
         labels = list(map(int,labels))
@@ -53,9 +54,10 @@ def test_epoch(epoch, data_loader, model, criterion, opt, logger):
             inputs = [list(inputs_1), labels]
             loss, outputs = model(inputs)
 
-            cam = ScoreCAM(model_val, ['module.Resnet.layer4','module.dfc_pyramid.dfc_encoder_40','module.Resnet.layer4',
-                                       'module.Resnet.layer4'], batch_size=2,
-                   input_shape=[[inputs[0][0].shape[1:],inputs[0][1].shape[1:],inputs[0][2].shape[1:],inputs[0][3].shape[1:]],inputs[1].shape])
+            if cam is None:
+                cam = ScoreCAM(model_val, ['module.Resnet.layer4','module.dfc_pyramid.dfc_encoder_40','module.Resnet.layer4',
+                                           'module.Resnet.layer4'], batch_size=2,
+                       input_shape=[[inputs[0][0].shape[1:],inputs[0][1].shape[1:],inputs[0][2].shape[1:],inputs[0][3].shape[1:]],inputs[1].shape])
             out = model_val(inputs)
             # select the activation map of specific class
             Map = cam(class_idx=1)
@@ -106,6 +108,8 @@ def test_epoch(epoch, data_loader, model, criterion, opt, logger):
         _, pred = outputs.topk(k=1, dim=1, largest=True)
         pred_arr = torch.cat([pred_arr, pred], dim=0)
         labels_arr = torch.cat([labels_arr, labels], dim=0)
+    if cam is not None:
+        cam.remove_hooks()
     print('prediction :', end=' ')
     for i in range(4, len(pred_arr)):
         print('%d\t'%(pred_arr[i]), end='')